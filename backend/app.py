@@ -3,22 +3,100 @@ Simple RAG Chat Agent - Backend
 FastAPI server with Ollama + ChromaDB
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from contextlib import aclosing, asynccontextmanager
+from collections import OrderedDict
+from urllib.parse import urlsplit
 
-import json
+import httpx
+import numpy as np
 import ollama
+import orjson
 import chromadb
 import uuid
+import hashlib
 import os
+import time
+import asyncio
+import logging
 
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
 
+logger = logging.getLogger(__name__)
+
 # ============== Configuration ==============
+def normalize_ollama_host(host: str) -> str:
+    """
+    Turn an OLLAMA_HOST value into a full base URL, read the same way as
+    Ollama does: "0.0.0.0" or "localhost:11434" get the http scheme and
+    the default port, so every client can use the value as-is
+    """
+    host = host.strip() or "127.0.0.1"
+    scheme_given = "://" in host
+    url = urlsplit(host if scheme_given else "http://" + host)
+    hostname = url.hostname or "127.0.0.1"
+    if ":" in hostname:
+        hostname = f"[{hostname}]"  # IPv6 literal
+    port = url.port
+    if port is None:
+        port = (443 if url.scheme == "https" else 80) if scheme_given else 11434
+    return f"{url.scheme}://{hostname}:{port}{url.path.rstrip('/')}"
+
+
+OLLAMA_HOST = normalize_ollama_host(os.getenv("OLLAMA_HOST", "http://localhost:11434"))
 CHAT_MODEL = "llama3.2:3b"
 EMBED_MODEL = "nomic-embed-text"
+QUERY_CACHE_SIZE = 2048
+
+# Documents are deleted in pages of this many ids
+DELETE_PAGE_SIZE = 1000
+
+# Vector searches arriving within this window share one ChromaDB query
+SEARCH_BATCH_WINDOW = 0.005
+
+# Semantic cache: reuse search results of a recent query whose embedding
+# has at least this cosine similarity with the new one
+SEMANTIC_CACHE_SIZE = 256
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# Small talk that never needs a knowledge base lookup
+SMALL_TALK = {
+    "hi", "hello", "hey", "thanks", "thank you", "thx", "ok", "okay",
+    "bye", "goodbye", "yes", "no", "cool", "nice", "great",
+}
+
+# WebSocket token batching: flush after this many tokens or seconds
+TOKEN_FLUSH_SIZE = 8
+TOKEN_FLUSH_INTERVAL = 0.04
+
+# Max concurrent Ollama calls, match the server's OLLAMA_NUM_PARALLEL
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+
+# Keep models loaded between requests: avoids reload latency, and lets
+# Ollama reuse the KV cache of the shared chat prompt prefix
+OLLAMA_KEEP_ALIVE = "30m"
+
+# HNSW index parameters for the documents collection, overridable from the
+# environment. The knowledge base is small and queries only ask for the top
+# 3, so a modest search_ef already reaches full recall while visiting fewer
+# graph nodes. These only take effect when the collection is first created.
+HNSW_M = int(os.getenv("CHROMA_HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("CHROMA_HNSW_EF_CONSTRUCTION", "100"))
+HNSW_EF_SEARCH = int(os.getenv("CHROMA_HNSW_EF_SEARCH", "32"))
+
+# Streamed Ollama output is buffered between Ollama and the client, so a
+# slow client does not hold an Ollama slot. If the buffer stays full this
+# long, the client has stopped reading and generation is aborted
+STREAM_BUFFER_SIZE = 4096
+STREAM_PUT_TIMEOUT = 30
+
+# Websocket conversation history: keep at most this many recent turns
+# within an approximate token budget; older turns are summarized
+MAX_HISTORY_TURNS = 6
+MAX_HISTORY_TOKENS = 2048
 
 SYSTEM_PROMPT = """You are Sya, Yoseph Bernandus's personal AI assistant. \
 When someone asks who you are, introduce yourself as: \
@@ -26,6 +104,25 @@ When someone asks who you are, introduce yourself as: \
 Always answer questions about Yoseph based on the provided context. \
 Be friendly and helpful."""
 
+# RAG instructions live in the system message so the prompt prefix is
+# identical on every call; only context and question change per request
+RAG_SYSTEM_PROMPT = SYSTEM_PROMPT + """ \
+Answer the question based on the context given with it. \
+If the context doesn't contain relevant information, say so."""
+
+SUMMARY_PROMPT = """Summarize the conversation below in a few sentences. \
+Keep names, facts and open questions. Reply with the summary only.
+
+{conversation}"""
+
+RAG_PROMPT = """Context:
+{context}
+
+Question: {question}"""
+
+SOURCE_PREVIEW_LEN = 100
+CONTEXT_SEP = "\n\n"
+
 
 # ============== Request Models ==============
 class ChatRequest(BaseModel):
@@ -37,8 +134,122 @@ class DocumentRequest(BaseModel):
     source: str
 
 
+class DocumentBatchRequest(BaseModel):
+    documents: list[DocumentRequest]
+
+
 # ============== App Setup ==============
-app = FastAPI(title="Simple RAG Chat")
+# One shared connection pool to Ollama for the whole app, so every request
+# reuses keep-alive connections instead of opening a new one per call
+ollama_transport = httpx.AsyncHTTPTransport(
+    limits=httpx.Limits(
+        max_keepalive_connections=40, max_connections=100, keepalive_expiry=30
+    ),
+)
+
+# ollama-python client for regular chat/embed calls
+ollama_client = ollama.AsyncClient(
+    host=OLLAMA_HOST,
+    timeout=300,
+    follow_redirects=False,
+    transport=ollama_transport,
+)
+
+# Plain HTTP client for streaming /api/chat through untouched
+ollama_http = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    timeout=300,
+    follow_redirects=False,
+    transport=ollama_transport,
+)
+
+
+# Bound in-flight Ollama calls so extra requests wait here instead of
+# piling up inside Ollama and blowing up tail latency
+ollama_semaphore = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+ollama_stats = {"in_flight": 0, "waiting": 0}
+
+
+@asynccontextmanager
+async def ollama_slot():
+    """Hold one of the OLLAMA_NUM_PARALLEL slots for an Ollama call"""
+    ollama_stats["waiting"] += 1
+    try:
+        await ollama_semaphore.acquire()
+    finally:
+        ollama_stats["waiting"] -= 1
+
+    ollama_stats["in_flight"] += 1
+    try:
+        yield
+    finally:
+        ollama_stats["in_flight"] -= 1
+        ollama_semaphore.release()
+
+
+async def decoupled_stream(open_stream):
+    """
+    Consume an Ollama stream in a background task while holding a slot,
+    and yield its items to the caller through a bounded queue
+    The slot is released as soon as Ollama is done, not when the client
+    has finished reading, so clients that stop reading cannot pin slots
+    """
+    queue = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+    end = object()
+
+    async def produce():
+        try:
+            async with ollama_slot(), aclosing(open_stream()) as stream:
+                async for item in stream:
+                    await asyncio.wait_for(queue.put(item), STREAM_PUT_TIMEOUT)
+        except asyncio.TimeoutError as exc:
+            # The client stopped reading: drop the backlog it never read, so
+            # it gets the abort right away instead of after the whole buffer
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(exc)
+        except Exception as exc:
+            await queue.put(exc)
+        else:
+            await queue.put(end)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Run the search batcher while the app is up, and close the shared
+    Ollama connection pool on shutdown
+    """
+    search_batcher_state["queue"] = asyncio.Queue()
+    search_batcher_state["task"] = asyncio.create_task(
+        search_batcher(search_batcher_state["queue"])
+    )
+    search_batcher_state["task"].add_done_callback(log_search_batcher_exit)
+    yield
+    search_batcher_state["task"].cancel()
+    search_batcher_state["task"] = None
+    search_batcher_state["queue"] = None
+    # Closing the client also closes the shared transport and its pool
+    await ollama_http.aclose()
+
+
+app = FastAPI(
+    title="Simple RAG Chat",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # CORS - allows frontend to call backend
 app.add_middleware(
@@ -49,62 +260,541 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-chroma_client = chromadb.Client()
+# Persist to disk so embeddings survive restarts
+chroma_client = chromadb.PersistentClient(path=os.getenv("CHROMA_DIR", "./chroma_data"))
+
+collection = chroma_client.get_or_create_collection(
+    name="documents",
+    metadata={
+        "description": "Knowledge base documents",
+        "hnsw:space": "cosine",
+        "hnsw:construction_ef": HNSW_EF_CONSTRUCTION,
+        "hnsw:M": HNSW_M,
+        "hnsw:search_ef": HNSW_EF_SEARCH,
+    },
+)
+
+# An existing collection keeps the HNSW settings it was created with
+for name, wanted in (
+    ("hnsw:M", HNSW_M),
+    ("hnsw:construction_ef", HNSW_EF_CONSTRUCTION),
+    ("hnsw:search_ef", HNSW_EF_SEARCH),
+):
+    current = (collection.metadata or {}).get(name)
+    if current != wanted:
+        logger.warning(
+            "Collection %s has %s=%s, ignoring configured %s; "
+            "recreate the collection to apply it",
+            collection.name, name, current, wanted,
+        )
+
+
+# ============== Caches ==============
+# LRU caches for repeated queries, keyed by a hash of the normalized text:
+# text -> embedding, and (text, n_results) -> search results
+# Cached embeddings are kept as float16 arrays (~1.5 KB for 768 dims)
+# instead of lists of Python floats (~24 KB), so a full cache stays small
+query_embedding_cache: OrderedDict = OrderedDict()
+search_results_cache: OrderedDict = OrderedDict()
+
+# (text, n_results) -> (int8-quantized unit query vector, search results)
+semantic_cache: OrderedDict = OrderedDict()
+
+# Bumped whenever the knowledge base changes, so a search that started
+# before the change does not store its stale results afterwards
+search_cache_state = {"generation": 0}
+
+cache_stats = {
+    "embedding_hits": 0,
+    "embedding_misses": 0,
+    "search_hits": 0,
+    "semantic_hits": 0,
+    "search_misses": 0,
+}
 
-try:
-    collection = chroma_client.get_collection("documents")
-except:
-    collection = chroma_client.create_collection(
-        name="documents", metadata={"description": "Knowledge base documents"}
+
+def cache_get(cache: OrderedDict, key):
+    """Return a cached value and mark it as recently used, or None"""
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+
+def cache_put(cache: OrderedDict, key, value):
+    """Store a value, evicting the least recently used entry when full"""
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > QUERY_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def normalize_query(text: str) -> str:
+    return text.strip().lower()
+
+
+def cache_key(text: str) -> bytes:
+    """Short fixed-size cache key, so long texts are not kept as dict keys"""
+    return hashlib.blake2b(normalize_query(text).encode(), digest_size=16).digest()
+
+
+INT8_SCALE = 127
+
+
+def quantize_int8(vector: np.ndarray) -> np.ndarray:
+    """
+    Scalar-quantize a vector to int8 after normalizing it to unit length
+    4x smaller than float32, and cosine error stays around 1e-3
+    """
+    v = vector.astype(np.float32)
+    v /= np.linalg.norm(v) or 1.0
+    return np.clip(np.rint(v * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+
+def semantic_cache_get(query_embedding: np.ndarray, n_results: int):
+    """
+    Return cached results of the most similar recent query, or None
+    All cached vectors are compared with one matrix-vector product
+    """
+    entries = [
+        entry for (_, n), entry in semantic_cache.items() if n == n_results
+    ]
+    if not entries:
+        return None
+
+    # int8 dot products accumulated in int32, scaled back to cosine
+    q = quantize_int8(query_embedding).astype(np.int32)
+    cached = np.stack([vector for vector, _ in entries]).astype(np.int32)
+    similarities = (cached @ q) / (INT8_SCALE * INT8_SCALE)
+
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    return entries[best][1]
+
+
+def semantic_cache_put(key: bytes, n_results: int, query_embedding, documents):
+    """Remember a query vector with its results, evicting the oldest when full"""
+    semantic_cache[(key, n_results)] = (quantize_int8(query_embedding), documents)
+    semantic_cache.move_to_end((key, n_results))
+    if len(semantic_cache) > SEMANTIC_CACHE_SIZE:
+        semantic_cache.popitem(last=False)
+
+
+def invalidate_search_caches():
+    """Knowledge base changed, cached search results are stale"""
+    search_cache_state["generation"] += 1
+    search_results_cache.clear()
+    semantic_cache.clear()
+
+
+def is_small_talk(text: str) -> bool:
+    """Greetings and acknowledgements like "hi" or "thanks!" """
+    return normalize_query(text).strip(" .!?,") in SMALL_TALK
+
+
+def trim_history(
+    history: list[dict],
+    max_turns: int = MAX_HISTORY_TURNS,
+    max_tokens: int = MAX_HISTORY_TOKENS,
+) -> list[dict]:
+    """
+    Drop the oldest user/assistant turns until the history fits both the
+    turn limit and the token budget, and return the dropped messages
+    Tokens are approximated as len(content) // 4
+    """
+    evicted = []
+    total = sum(len(h["content"]) // 4 for h in history)
+    while history and (len(history) > max_turns * 2 or total > max_tokens):
+        # Evict a whole turn (user + assistant) at a time
+        for h in history[:2]:
+            total -= len(h["content"]) // 4
+        evicted.extend(history[:2])
+        del history[:2]
+
+    logger.debug(
+        "History: %d messages, ~%d tokens, %d evicted",
+        len(history), total, len(evicted),
     )
+    return evicted
 
 
-def create_embedding(text: str) -> list[float]:
+async def summarize_history(summary: str, evicted: list[dict]) -> str:
+    """
+    Fold evicted turns into the running conversation summary
+    """
+    lines = [f"Summary so far: {summary}"] if summary else []
+    lines += [f'{h["role"]}: {h["content"]}' for h in evicted]
+    prompt = SUMMARY_PROMPT.format(conversation="\n".join(lines))
+
+    async with ollama_slot():
+        response = await ollama_client.chat(
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
+    return response["message"]["content"]
+
+
+# Last timestamp and rand_a counter handed out by new_doc_id
+doc_id_state = {"ms": 0, "counter": 0}
+
+
+def new_doc_id() -> str:
+    """
+    Time-ordered UUIDv7 (RFC 9562) for document ids
+    Ids created together sort together, so bulk inserts stay local
+    in ChromaDB's storage instead of scattering like random uuid4s
+    Within one millisecond the 12-bit rand_a field is a counter (RFC 9562
+    method 1), so ids are strictly increasing in creation order
     """
-    Convert text into a vector (list of numbers)
+    ts_ms = time.time_ns() // 1_000_000
+    if ts_ms > doc_id_state["ms"]:
+        # New millisecond: random counter start, top bit clear to leave room
+        counter = int.from_bytes(os.urandom(2), "big") & 0x7FF
+    else:
+        # Same millisecond (or the clock went back): keep counting
+        ts_ms = doc_id_state["ms"]
+        counter = doc_id_state["counter"] + 1
+        if counter > 0xFFF:
+            ts_ms += 1
+            counter = 0
+    doc_id_state["ms"] = ts_ms
+    doc_id_state["counter"] = counter
+
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (ts_ms << 80) | (0x7 << 76) | (counter << 64) | (0x2 << 62) | rand_b
+    return str(uuid.UUID(int=value))
+
+
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+
+def sse_event(data: dict) -> bytes:
+    """Encode one Server-Sent Event frame as bytes"""
+    return SSE_PREFIX + orjson.dumps(data) + SSE_SUFFIX
+
+
+# The done frame never changes, so encode it once
+SSE_DONE = sse_event({"type": "done"})
+
+
+# Token frames are sent thousands of times per answer, so only the token
+# itself is encoded per frame and the fixed JSON around it is prebuilt
+WS_TOKEN_PREFIX = '{"type":"token","data":'
+WS_DONE = orjson.dumps({"type": "done"}).decode()
+
+
+def ws_token(text: str) -> str:
+    """WebSocket text frame for a batch of tokens"""
+    return WS_TOKEN_PREFIX + orjson.dumps(text).decode() + "}"
+
+
+async def create_embedding(text: str | list[str]) -> np.ndarray:
+    """
+    Convert text into vectors (list of numbers)
     Similiar texts have similar vectors
+    Accepts a single text or a list of texts, so bulk ingestion
+    can embed everything in one Ollama call
+    Returns a 2-D float32 array with one row per text
     """
-    response = ollama.embed(model=EMBED_MODEL, input=text)
-    return response["embeddings"][0]
+    async with ollama_slot():
+        response = await ollama_client.embed(
+            model=EMBED_MODEL, input=text, keep_alive=OLLAMA_KEEP_ALIVE
+        )
+    return np.asarray(response["embeddings"], dtype=np.float32)
+
+
+# The running search_batcher task and its queue of pending searches
+# (query embedding, n_results, future). Both are created in the lifespan,
+# so they belong to the event loop that is serving requests
+search_batcher_state = {"task": None, "queue": None}
 
 
-def search_documents(query: str, n_results: int = 3):
+async def search_batcher(search_queue: asyncio.Queue):
+    """
+    Background task that runs queued vector searches in batches
+    Waits SEARCH_BATCH_WINDOW after the first search arrives, then sends
+    everything queued so far to ChromaDB in one query per n_results
+    """
+    while True:
+        batch = [await search_queue.get()]
+        await asyncio.sleep(SEARCH_BATCH_WINDOW)
+        while not search_queue.empty():
+            batch.append(search_queue.get_nowait())
+
+        groups = {}
+        for embedding, n_results, future in batch:
+            groups.setdefault(n_results, []).append((embedding, future))
+
+        for n_results, items in groups.items():
+            try:
+                results = await asyncio.to_thread(
+                    collection.query,
+                    query_embeddings=[embedding for embedding, _ in items],
+                    n_results=n_results,
+                )
+            except Exception as exc:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            # Hand each caller its own row, shaped like a single-query result
+            # A malformed row fails only its own caller, never the batcher
+            distances = results.get("distances")
+            for i, (_, future) in enumerate(items):
+                if future.done():
+                    continue
+                try:
+                    future.set_result(
+                        {
+                            "ids": [results["ids"][i]],
+                            "documents": [results["documents"][i]],
+                            "metadatas": [results["metadatas"][i]],
+                            "distances": [distances[i]] if distances else None,
+                        }
+                    )
+                except Exception as exc:
+                    future.set_exception(exc)
+
+
+def log_search_batcher_exit(task: asyncio.Task):
+    """Done callback: the batcher only stops on its own if it crashed"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Search batcher stopped", exc_info=task.exception())
+
+
+async def query_collection(embedding: np.ndarray, n_results: int) -> dict:
+    """Queue one vector search for the batcher and wait for its result"""
+    # Without a running batcher the search would wait forever
+    batcher = search_batcher_state["task"]
+    if batcher is None or batcher.done():
+        cause = None
+        if batcher is not None and not batcher.cancelled():
+            cause = batcher.exception()
+        raise RuntimeError("Search batcher is not running") from cause
+    future = asyncio.get_running_loop().create_future()
+    await search_batcher_state["queue"].put(
+        (embedding.astype(np.float32).tolist(), n_results, future)
+    )
+    return await future
+
+
+async def search_documents(query: str, n_results: int = 3):
     """
     Search for documents similiar to the query
     Steps:
     1. Convert query to vector
     2. Find similar documents in ChromaDB
-    3. Return top N results with similarity scores
+    3. Return top N results with similarity scores and content previews
+    Small talk skips the search entirely and returns no documents
     """
-    # Embed the query
-    query_embedding = create_embedding(query)
+    if is_small_talk(query):
+        return []
+
+    key = cache_key(query)
+    generation = search_cache_state["generation"]
 
-    # Search ChromaDB for similar documents
-    results = collection.query(query_embeddings=[query_embedding], n_results=n_results)
+    # Repeated query - skip both the embedding and the vector search
+    cached = cache_get(search_results_cache, (key, n_results))
+    if cached is not None:
+        cache_stats["search_hits"] += 1
+        return cached
 
-    # Format results
+    # Embed the query
+    query_embedding = cache_get(query_embedding_cache, (EMBED_MODEL, key))
+    if query_embedding is None:
+        cache_stats["embedding_misses"] += 1
+        query_embedding = (await create_embedding(query))[0].astype(np.float16)
+        cache_put(query_embedding_cache, (EMBED_MODEL, key), query_embedding)
+    else:
+        cache_stats["embedding_hits"] += 1
+
+    # Near-duplicate of a recent query - reuse its results
+    cached = semantic_cache_get(query_embedding, n_results)
+    if cached is not None:
+        cache_stats["semantic_hits"] += 1
+        cache_put(search_results_cache, (key, n_results), cached)
+        return cached
+    cache_stats["search_misses"] += 1
+
+    # Search ChromaDB for similar documents, batched with concurrent searches
+    results = await query_collection(query_embedding, n_results)
+
+    # Format results (single query, so only row 0 of each field is used)
     documents = []
     if results["ids"] and len(results["ids"][0]) > 0:
-        for i in range(len(results["ids"][0])):
-            documents.append(
-                {
-                    "id": results["ids"][0][i],
-                    "content": results["documents"][0][i],
-                    "source": results["metadatas"][0][i]["source"],
-                    "score": results["distances"][0][i]
-                    if "distances" in results
-                    else 0,
-                }
+        ids = results["ids"][0]
+        distances = results["distances"][0] if results.get("distances") else [0] * len(ids)
+        documents = [
+            {
+                "id": doc_id,
+                "content": content,
+                "preview": content[:SOURCE_PREVIEW_LEN] + "...",
+                "source": meta["source"],
+                "score": score,
+            }
+            for doc_id, content, meta, score in zip(
+                ids, results["documents"][0], results["metadatas"][0], distances
             )
+        ]
 
+    # Documents were added or removed while searching, don't cache
+    if generation == search_cache_state["generation"]:
+        cache_put(search_results_cache, (key, n_results), documents)
+        semantic_cache_put(key, n_results, query_embedding, documents)
     return documents
 
 
+def build_rag_context(docs: list[dict]) -> tuple[str, list[dict]]:
+    """
+    Build the prompt context and the source previews in a single pass
+    over the retrieved documents
+    """
+    contents = []
+    sources = []
+    for doc in docs:
+        contents.append(doc["content"])
+        sources.append(
+            {
+                "content": doc["preview"],
+                "source": doc["source"],
+                "score": doc["score"],
+            }
+        )
+    return CONTEXT_SEP.join(contents), sources
+
+
+def build_rag_prompt(question: str, context: str) -> tuple[str, str]:
+    """
+    Pick the system prompt and user prompt for a RAG turn
+    Without retrieved context (small talk, or nothing relevant stored) the
+    turn is answered like direct mode, instead of telling the model to
+    rely on an empty context
+    """
+    if not context:
+        return SYSTEM_PROMPT, question
+    return RAG_SYSTEM_PROMPT, RAG_PROMPT.format(context=context, question=question)
+
+
+async def add_documents(docs: list[dict]) -> list[str]:
+    """
+    Add documents to the knowledge base in bulk
+    Steps:
+    1. Embed every document content in a single Ollama call
+    2. Store them all with one ChromaDB add
+    3. Prime the query embedding cache with the new embeddings
+    """
+    ids = [new_doc_id() for _ in docs]
+    contents = [doc["content"] for doc in docs]
+    metas = [{"source": doc["source"]} for doc in docs]
+    embeddings = await create_embedding(contents)
+
+    await asyncio.to_thread(
+        collection.add,
+        ids=ids,
+        embeddings=embeddings.tolist(),
+        documents=contents,
+        metadatas=metas,
+    )
+    # Knowledge base changed, cached search results are stale
+    invalidate_search_caches()
+    # Searching for this exact content later reuses the embedding
+    for content, embedding in zip(contents, embeddings):
+        cache_put(
+            query_embedding_cache,
+            (EMBED_MODEL, cache_key(content)),
+            embedding.astype(np.float16),
+        )
+
+    return ids
+
+
+def raise_for_stream_error(line: bytes):
+    """
+    Raise ollama.ResponseError if an NDJSON line from Ollama's stream is an
+    {"error": ...} line, as ollama-python does for the calls it makes
+    Token text is JSON-escaped, so a cheap byte check skips normal chunks
+    """
+    if b'"error"' in line:
+        error = orjson.loads(line).get("error")
+        if error:
+            raise ollama.ResponseError(error)
+
+
+async def stream_chat_sse(messages: list[dict]):
+    """
+    Forward Ollama's streamed chat chunks as SSE frames
+    Each NDJSON line from /api/chat is passed through as the frame's data
+    without being decoded and re-encoded, so clients read the token from
+    {"message": {"content": ...}}. Ends with a {"type": "done"} frame
+    An {"error": ...} line from Ollama is forwarded for the client to show,
+    then ends the stream with ollama.ResponseError
+    """
+    payload = {
+        "model": CHAT_MODEL,
+        "messages": messages,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+    }
+
+    async def frames():
+        async with ollama_http.stream("POST", "/api/chat", json=payload) as response:
+            response.raise_for_status()
+            # Split the raw bytes on newlines ourselves, so lines are never
+            # decoded to str and encoded back
+            pending = b""
+            async for data in response.aiter_bytes():
+                *lines, pending = (pending + data).split(b"\n")
+                for line in lines:
+                    if line:
+                        yield SSE_PREFIX + line + SSE_SUFFIX
+                        raise_for_stream_error(line)
+            if pending:
+                yield SSE_PREFIX + pending + SSE_SUFFIX
+                raise_for_stream_error(pending)
+
+    async for frame in decoupled_stream(frames):
+        yield frame
+
+    yield SSE_DONE
+
+
+async def stream_chat_tokens(messages: list[dict]):
+    """Yield the non-empty tokens of a streamed Ollama chat response"""
+
+    async def tokens():
+        async for chunk in await ollama_client.chat(
+            model=CHAT_MODEL,
+            messages=messages,
+            stream=True,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        ):
+            token = chunk["message"]["content"]
+            if token:
+                yield token
+
+    async for token in decoupled_stream(tokens):
+        yield token
+
+
 # ============== Health Check ==============
 @app.get("/health")
 async def health_check():
-    """Check if server is running"""
-    return {"status": "ok"}
+    """Check if server is running, with query cache hit/miss counters"""
+    return {"status": "ok", "cache": cache_stats}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Ollama concurrency: calls running now and calls waiting for a slot"""
+    return {
+        "ollama_max_parallel": OLLAMA_NUM_PARALLEL,
+        "ollama_in_flight": ollama_stats["in_flight"],
+        "ollama_waiting": ollama_stats["waiting"],
+    }
 
 
 @app.post("/chat")
@@ -114,12 +804,14 @@ async def chat_direct(request: ChatRequest):
     Just sends the user's message to Ollama and returns the response
     """
     # Call Ollama's chat API
-    response = ollama.chat(
-        model=CHAT_MODEL, messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": request.message},
-        ]
-    )
+    async with ollama_slot():
+        response = await ollama_client.chat(
+            model=CHAT_MODEL, messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": request.message},
+            ],
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
 
     # Extract the answer from the response
     answer = response["message"]["content"]
@@ -127,48 +819,51 @@ async def chat_direct(request: ChatRequest):
     return {"answer": answer, "mode": "direct"}
 
 
+@app.post("/chat/stream")
+async def chat_direct_stream(request: ChatRequest):
+    """
+    Direct chat with streaming (Server-Sent Events)
+    Sends tokens as they're generated instead of waiting for the full answer
+    """
+
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": request.message},
+    ]
+
+    return StreamingResponse(stream_chat_sse(messages), media_type="text/event-stream")
+
+
 @app.post("/chat/rag")
 async def chat_rag(request: ChatRequest):
     """
     RAG Chat - Search knowledge base first, then generate answer
     """
     # Step 1: Search for relevant documents
-    relevant_docs = search_documents(request.message, n_results=3)
+    relevant_docs = await search_documents(request.message, n_results=3)
 
-    # Step 2: Build context from retrieved documents
-    context = "\n\n".join([doc["content"] for doc in relevant_docs])
+    # Step 2: Build context and sources from retrieved documents
+    context, sources = build_rag_context(relevant_docs)
 
     # Step 3: Create prompt with context
-    prompt = f"""Answer the question based on the following context. If the context doesn't contain relevant information, say so.
-
-    Context:
-    {context}
-
-    Question: {request.message}
-
-    Answer:"""
+    system_prompt, prompt = build_rag_prompt(request.message, context)
 
     # Step 4: Generate answer with LLM
-    response = ollama.chat(
-        model=CHAT_MODEL, messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt},
-        ]
-    )
+    async with ollama_slot():
+        response = await ollama_client.chat(
+            model=CHAT_MODEL, messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            keep_alive=OLLAMA_KEEP_ALIVE,
+        )
 
     answer = response["message"]["content"]
 
     # Step 5: Return answer with sources
     return {
         "answer": answer,
-        "sources": [
-            {
-                "content": doc["content"][:100] + "...",  # Preview
-                "source": doc["source"],
-                "score": doc["score"],
-            }
-            for doc in relevant_docs
-        ],
+        "sources": sources,
         "mode": "rag",
     }
 
@@ -182,50 +877,24 @@ async def chat_rag_stream(request: ChatRequest):
 
     async def generate():
         # Step 1: Search for relevant documents
-        relevant_docs = search_documents(request.message, n_results=3)
+        relevant_docs = await search_documents(request.message, n_results=3)
 
         # Step 2: Send source first
-        source_data = {
-            "type": "sources",
-            "content": [
-                {
-                    "content": doc["content"][:100] + "...",
-                    "source": doc["source"],
-                    "score": doc["score"],
-                }
-                for doc in relevant_docs
-            ],
-        }
-
-        yield f"data: {json.dumps(source_data)}\n\n"
+        context, sources = build_rag_context(relevant_docs)
+        source_data = {"type": "sources", "content": sources}
 
-        # Step 3: Build Context and prompt
-        context = "\n\n".join([doc["content"] for doc in relevant_docs])
-        prompt = f"""Answer the question based on the following context. If the context doesn't contain relevant information, say so.
+        yield sse_event(source_data)
 
-        Context:
-        {context}
+        # Step 3: Build prompt
+        system_prompt, prompt = build_rag_prompt(request.message, context)
 
-        Question: {request.message}
-
-        Answer:"""
-
-        # Step 4: Stream tokens from LLM
-        for chunk in ollama.chat(
-            model=CHAT_MODEL,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
-            ],
-            stream=True,
-        ):
-            token = chunk["message"]["content"]
-            if token:
-                token_data = {"type": "token", "content": token}
-                yield f"data: {json.dumps(token_data)}\n\n"
-
-        # Step 5: Send done signal
-        yield f"data: {json.dumps({'type': 'done'})}\n\n"
+        # Step 4: Stream tokens from LLM, followed by the done signal
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ]
+        async for frame in stream_chat_sse(messages):
+            yield frame
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
@@ -238,42 +907,55 @@ async def add_document(request: DocumentRequest):
     1. Generate embedding for the document content
     2. Store in ChromaDB with metadata
     """
-    # Generate unique ID for this document
-    doc_id = str(uuid.uuid4())
+    doc_ids = await add_documents([request.model_dump()])
 
-    # Convert text to vector
-    embedding = create_embedding(request.content)
+    return {"success": True, "id": doc_ids[0]}
 
-    # Store in ChromaDB
-    collection.add(
-        ids=[doc_id],
-        embeddings=[embedding],
-        documents=[request.content],
-        metadatas=[{"source": request.source}],
-    )
 
-    return {"success": True, "id": doc_id}
+@app.post("/documents/batch")
+async def add_documents_batch(request: DocumentBatchRequest):
+    """
+    Add many documents at once
+    All contents are embedded in one Ollama call instead of one per document
+    """
+    if not request.documents:
+        return {"success": True, "ids": []}
+
+    doc_ids = await add_documents([doc.model_dump() for doc in request.documents])
+
+    return {"success": True, "ids": doc_ids}
 
 
 @app.get("/documents")
-async def list_documents():
+async def list_documents(
+    limit: int | None = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
+):
     """
-    Get all documents in the knowledge base
+    Get documents in the knowledge base, all of them by default
+    Use limit/offset to page through large collections
+    `count` is the number of rows in this page, `total` the number of
+    documents in the collection
+    Rows are streamed one by one instead of building the whole list first
     """
-    # Get all documents from collection
-    data = collection.get()
+    # Get documents from collection (ids are always included)
+    data = await asyncio.to_thread(
+        collection.get,
+        limit=limit,
+        offset=offset or None,
+        include=["documents", "metadatas"],
+    )
+    total = await asyncio.to_thread(collection.count)
 
-    return {
-        "count": len(data["ids"]),
-        "documents": [
-            {
-                "id": data["ids"][i],
-                "content": data["documents"][i],
-                "source": data["metadatas"][i]["source"],
-            }
-            for i in range(len(data["ids"]))
-        ],
-    }
+    def generate():
+        yield b'{"count": %d, "total": %d, "documents": [' % (len(data["ids"]), total)
+        rows = zip(data["ids"], data["documents"], data["metadatas"])
+        for i, (doc_id, content, meta) in enumerate(rows):
+            row = {"id": doc_id, "content": content, "source": meta["source"]}
+            yield (b"," if i else b"") + orjson.dumps(row)
+        yield b"]}"
+
+    return StreamingResponse(generate(), media_type="application/json")
 
 
 @app.post("/documents/seed")
@@ -308,34 +990,52 @@ async def seed_documents():
         },
     ]
 
-    # Add each sample document
-    for doc in SAMPLE_DOCS:
-        doc_id = str(uuid.uuid4())
-        embedding = create_embedding(doc["content"])
+    # The collection is persistent, so skip re-embedding if already seeded
+    existing = await asyncio.to_thread(
+        collection.get,
+        where={"source": {"$in": [doc["source"] for doc in SAMPLE_DOCS]}},
+        limit=1,
+        include=[],
+    )
+    if existing["ids"]:
+        return {"success": True, "added": 0, "note": "already seeded"}
 
-        collection.add(
-            ids=[doc_id],
-            embeddings=[embedding],
-            documents=[doc["content"]],
-            metadatas=[{"source": doc["source"]}],
-        )
+    # Embed all sample documents in a single call and store them at once
+    await add_documents(SAMPLE_DOCS)
 
     return {"success": True, "added": len(SAMPLE_DOCS)}
 
 
+@app.post("/documents/reseed")
+async def reseed_documents():
+    """
+    Clear the knowledge base and add the sample documents again
+    """
+    await clear_documents()
+    return await seed_documents()
+
+
 @app.delete("/documents")
 async def clear_documents():
     """
     Delete all documents from the knowledge base
+    Ids are fetched and deleted a page at a time, so the whole collection
+    is never loaded into memory at once
     """
-    # Get all document IDs
-    data = collection.get()
+    deleted = 0
+    while True:
+        page = await asyncio.to_thread(
+            collection.get, limit=DELETE_PAGE_SIZE, include=[]
+        )
+        if not page["ids"]:
+            break
+        await asyncio.to_thread(collection.delete, ids=page["ids"])
+        deleted += len(page["ids"])
 
-    if len(data["ids"]) > 0:
-        # Delete all documents
-        collection.delete(ids=data["ids"])
+    if deleted > 0:
+        invalidate_search_caches()
 
-    return {"success": True, "deleted": len(data["ids"])}
+    return {"success": True, "deleted": deleted}
 
 
 @app.websocket("/ws/chat")
@@ -347,10 +1047,14 @@ async def websocket_chat(websocket: WebSocket):
 
     # Step 1: Accept the websocket connection
     await websocket.accept()
-    print("Client connected to WebSocket")
+    logger.debug("Client connected to WebSocket")
 
-    # Keep conversation history for this session
+    # Keep conversation history for this session, with older turns
+    # folded into a summary
     history = []
+    summary = ""
+    summary_task = None
+    evicted = []
 
     try:
         # Step 2: Loop forever until client disconnects
@@ -360,44 +1064,43 @@ async def websocket_chat(websocket: WebSocket):
             message = data.get("message", "")
             mode = data.get("mode", "rag")  # direct or rag
 
-            print(f"Received: {message} (mode: {mode})")
+            logger.debug("Received: %s (mode: %s)", message, mode)
 
             # Step 4: Process based on mode
             if mode == "rag":
                 # Search knowledge base
-                relevant_docs = search_documents(message, n_results=3)
+                relevant_docs = await search_documents(message, n_results=3)
 
                 # Send source first
-                await websocket.send_json(
-                    {
-                        "type": "sources",
-                        "data": [
-                            {
-                                "content": doc["content"][:100] + "...",
-                                "source": doc["source"],
-                                "score": doc["score"],
-                            }
-                            for doc in relevant_docs
-                        ],
-                    }
+                context, sources = build_rag_context(relevant_docs)
+                await websocket.send_text(
+                    orjson.dumps({"type": "sources", "data": sources}).decode()
                 )
 
-                # Build context
-                context = "\n\n".join([doc["content"] for doc in relevant_docs])
-                prompt = f"""Answer the question based on the following context. If the context doesn't contain relevant information, say so.
-
-        Context:
-        {context}
-
-        Question: {message}
-        Answer:"""
+                # Build prompt
+                system_prompt, prompt = build_rag_prompt(message, context)
             else:
                 # Direct mode no RAG
+                system_prompt = SYSTEM_PROMPT
                 prompt = message
                 context = None
 
-            # Step 5: Build messages with history
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            # Step 5: Build messages with summary and history
+            if summary_task is not None:
+                try:
+                    summary = await summary_task
+                except Exception:
+                    # Keep the previous summary and put the evicted turns
+                    # back, so they are retried on the next trim
+                    logger.exception("Failed to summarize conversation history")
+                    history[:0] = evicted
+                summary_task = None
+
+            messages = [{"role": "system", "content": system_prompt}]
+            if summary:
+                messages.append(
+                    {"role": "system", "content": f"Earlier conversation summary: {summary}"}
+                )
 
             # add conversation history
             for h in history:
@@ -406,21 +1109,39 @@ async def websocket_chat(websocket: WebSocket):
             # Add current message
             messages.append({"role": "user", "content": prompt})
 
-            # Step 6: Stream LLM response token by token
-            full_response = ""
-            for chunk in ollama.chat(model=CHAT_MODEL, messages=messages, stream=True):
-                token = chunk["message"]["content"]
-                if token:
-                    full_response += token
-                    await websocket.send_json({"type": "token", "data": token})
+            # Step 6: Stream LLM response, coalescing tokens into fewer frames
+            parts = []
+            buf = []
+            last_flush = time.monotonic()
+            async for token in stream_chat_tokens(messages):
+                parts.append(token)
+                buf.append(token)
+                now = time.monotonic()
+                if len(buf) >= TOKEN_FLUSH_SIZE or now - last_flush > TOKEN_FLUSH_INTERVAL:
+                    await websocket.send_text(ws_token("".join(buf)))
+                    buf.clear()
+                    last_flush = now
+
+            # Flush whatever is left in the buffer
+            if buf:
+                await websocket.send_text(ws_token("".join(buf)))
+            full_response = "".join(parts)
 
             # Step 7: Send done signal
-            await websocket.send_json({"type": "done"})
+            await websocket.send_text(WS_DONE)
 
             # Step 8: Update history for multi-turn conversation
             history.append({"role": "user", "content": message})
             history.append({"role": "assistant", "content": full_response})
 
-            print(f"Sent response: {full_response[:50]}...")
+            # Summarize evicted turns in the background, off this turn's path
+            evicted = trim_history(history)
+            if evicted:
+                summary_task = asyncio.create_task(summarize_history(summary, evicted))
+
+            logger.debug("Sent response: %.50s...", full_response)
     except WebSocketDisconnect:
-        print("Client disconnected from WebSocket")
+        logger.debug("Client disconnected from WebSocket")
+    finally:
+        if summary_task is not None:
+            summary_task.cancel()
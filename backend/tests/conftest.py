@@ -0,0 +1,99 @@
+"""
+Shared fixtures: a throwaway ChromaDB directory and a fake Ollama, so the
+app can be exercised without a running Ollama server
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import httpx
+import numpy as np
+import ollama
+import pytest
+
+# The app opens its ChromaDB collection at import time
+os.environ["CHROMA_DIR"] = tempfile.mkdtemp(prefix="chat-agent-tests-")
+
+import app  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+EMBED_DIM = 64
+FAKE_TOKENS = ["Hello", " from", " fake", " Ollama"]
+
+
+def fake_embedding(text: str) -> list[float]:
+    """Deterministic pseudo-random vector for a text"""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "big")
+    return np.random.default_rng(seed).standard_normal(EMBED_DIM).tolist()
+
+
+class FakeOllama:
+    """
+    httpx MockTransport handler for /api/embed and /api/chat
+    Every request body is recorded in `requests` as (path, body)
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.fail_non_streaming_chat = False
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.requests.append((request.url.path, body))
+
+        if request.url.path == "/api/embed":
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            return httpx.Response(
+                200,
+                json={"model": body["model"], "embeddings": [fake_embedding(t) for t in texts]},
+            )
+
+        if request.url.path == "/api/chat":
+            if not body.get("stream"):
+                if self.fail_non_streaming_chat:
+                    return httpx.Response(500, json={"error": "model crashed"})
+                message = {"role": "assistant", "content": "".join(FAKE_TOKENS)}
+                return httpx.Response(200, json={"message": message, "done": True})
+
+            lines = [
+                {"message": {"role": "assistant", "content": token}, "done": False}
+                for token in FAKE_TOKENS
+            ]
+            lines.append({"message": {"role": "assistant", "content": ""}, "done": True})
+            content = b"".join(json.dumps(line).encode() + b"\n" for line in lines)
+            return httpx.Response(200, content=content)
+
+        return httpx.Response(404)
+
+    def chat_requests(self) -> list[dict]:
+        return [body for path, body in self.requests if path == "/api/chat"]
+
+
+@pytest.fixture(autouse=True)
+def empty_collection():
+    """Every test starts with an empty knowledge base and empty search caches"""
+    ids = app.collection.get(include=[])["ids"]
+    if ids:
+        app.collection.delete(ids=ids)
+    app.invalidate_search_caches()
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    fake = FakeOllama()
+    transport = httpx.MockTransport(fake)
+    monkeypatch.setattr(
+        app, "ollama_client", ollama.AsyncClient(host=app.OLLAMA_HOST, transport=transport)
+    )
+    monkeypatch.setattr(
+        app, "ollama_http", httpx.AsyncClient(base_url=app.OLLAMA_HOST, transport=transport)
+    )
+    return fake
+
+
+@pytest.fixture
+def client(fake_ollama):
+    with TestClient(app.app) as client:
+        yield client
@@ -0,0 +1,295 @@
+import asyncio
+import time
+import uuid
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+class RecordingCollection:
+    """Wraps the ChromaDB collection and records the size of each query batch"""
+
+    def __init__(self, collection, truncate_rows=False):
+        self.collection = collection
+        self.truncate_rows = truncate_rows
+        self.batch_sizes = []
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def query(self, **kwargs):
+        self.batch_sizes.append(len(kwargs["query_embeddings"]))
+        results = self.collection.query(**kwargs)
+        if self.truncate_rows:
+            # Simulate a result with fewer rows than queries
+            results = {k: v[:1] if v else v for k, v in results.items()}
+        return results
+
+
+def add_sample_documents():
+    docs = [{"content": f"Document number {i}", "source": f"doc-{i}.md"} for i in range(3)]
+    return app.add_documents(docs)
+
+
+# ============== Search batcher ==============
+
+
+def test_rag_search_works_across_app_restarts(fake_ollama):
+    for i in range(2):
+        with TestClient(app.app) as client:
+            client.post("/documents/seed")
+            response = client.post("/chat/rag", json={"message": f"Where does Yoseph work? {i}"})
+            assert response.status_code == 200
+            assert response.json()["sources"]
+
+
+def test_concurrent_searches_share_one_query(fake_ollama, monkeypatch):
+    recording = RecordingCollection(app.collection)
+    monkeypatch.setattr(app, "collection", recording)
+
+    async def run():
+        async with app.lifespan(app.app):
+            await add_sample_documents()
+            return await asyncio.gather(
+                *(app.search_documents(f"question {i}", n_results=2) for i in range(3))
+            )
+
+    results = asyncio.run(run())
+    assert recording.batch_sizes == [3]
+    assert [len(docs) for docs in results] == [2, 2, 2]
+
+
+def test_search_fails_fast_without_batcher(fake_ollama):
+    with pytest.raises(RuntimeError, match="not running"):
+        asyncio.run(app.search_documents("where does he work"))
+
+
+def test_bad_result_row_fails_only_its_caller(fake_ollama, monkeypatch):
+    monkeypatch.setattr(app, "collection", RecordingCollection(app.collection, truncate_rows=True))
+
+    async def run():
+        async with app.lifespan(app.app):
+            await add_sample_documents()
+            results = await asyncio.gather(
+                app.search_documents("first question"),
+                app.search_documents("second question"),
+                return_exceptions=True,
+            )
+            return results, app.search_batcher_state["task"].done()
+
+    (first, second), batcher_done = asyncio.run(run())
+    assert isinstance(first, list)
+    assert isinstance(second, IndexError)
+    assert not batcher_done
+
+
+def test_search_racing_an_invalidation_is_not_cached(fake_ollama, monkeypatch):
+    class InvalidatingCollection(RecordingCollection):
+        def query(self, **kwargs):
+            # Documents change while this search is in flight
+            app.invalidate_search_caches()
+            return super().query(**kwargs)
+
+    monkeypatch.setattr(app, "collection", InvalidatingCollection(app.collection))
+
+    async def run():
+        async with app.lifespan(app.app):
+            await add_sample_documents()
+            return await app.search_documents("racing question")
+
+    assert asyncio.run(run())
+    assert not app.search_results_cache
+    assert not app.semantic_cache
+
+
+# ============== Document ids ==============
+
+
+def test_doc_ids_are_time_ordered_uuid7():
+    ids = [app.new_doc_id() for _ in range(10_000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(uuid.UUID(doc_id).version == 7 for doc_id in ids)
+
+
+def test_doc_ids_keep_increasing_within_a_frozen_millisecond(monkeypatch):
+    now = time.time_ns()
+    monkeypatch.setattr(app.time, "time_ns", lambda: now)
+    # More ids than the 12-bit counter holds, so it must roll the timestamp
+    ids = [app.new_doc_id() for _ in range(5_000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_doc_ids_keep_increasing_when_the_clock_goes_back(monkeypatch):
+    first = app.new_doc_id()
+    monkeypatch.setattr(app.time, "time_ns", lambda: 0)
+    assert app.new_doc_id() > first
+
+
+def test_bulk_added_document_ids_are_ordered(client):
+    docs = [{"content": f"Note {i}", "source": f"note-{i}.md"} for i in range(50)]
+    ids = client.post("/documents/batch", json={"documents": docs}).json()["ids"]
+    assert ids == sorted(ids)
+
+
+# ============== Streaming ==============
+
+
+async def collect(stream) -> list:
+    return [item async for item in stream]
+
+
+def test_stream_releases_the_slot_before_the_client_reads():
+    async def tokens():
+        for token in ["a", "b", "c"]:
+            yield token
+
+    async def run():
+        stream = app.decoupled_stream(tokens)
+        first = await anext(stream)
+        await asyncio.sleep(0.01)  # Ollama is done, the client has not read yet
+        in_flight = app.ollama_stats["in_flight"]
+        return [first, *await collect(stream)], in_flight
+
+    assert asyncio.run(run()) == (["a", "b", "c"], 0)
+
+
+def test_stalled_client_is_aborted_without_the_backlog(monkeypatch):
+    monkeypatch.setattr(app, "STREAM_BUFFER_SIZE", 2)
+    monkeypatch.setattr(app, "STREAM_PUT_TIMEOUT", 0.01)
+
+    async def tokens():
+        for i in range(100):
+            yield i
+
+    async def run():
+        stream = app.decoupled_stream(tokens)
+        await anext(stream)
+        await asyncio.sleep(0.1)  # stop reading until the producer gives up
+        assert app.ollama_stats["in_flight"] == 0
+        with pytest.raises(asyncio.TimeoutError):
+            await anext(stream)
+
+    asyncio.run(run())
+
+
+def test_stream_error_arrives_after_earlier_items():
+    async def tokens():
+        yield "a"
+        raise ValueError("boom")
+
+    async def run():
+        received = []
+        with pytest.raises(ValueError, match="boom"):
+            async for token in app.decoupled_stream(tokens):
+                received.append(token)
+        return received
+
+    assert asyncio.run(run()) == ["a"]
+
+
+def test_sse_stream_passes_chunks_through(client):
+    frames = client.post("/chat/stream", json={"message": "hello"}).text.split("\n\n")
+    assert frames[0] == 'data: {"message": {"role": "assistant", "content": "Hello"}, "done": false}'
+    assert frames[-2] == 'data: {"type":"done"}'
+
+
+def test_websocket_streams_the_whole_answer(client):
+    with client.websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"message": "hello", "mode": "direct"})
+        answer = ""
+        while (frame := websocket.receive_json())["type"] != "done":
+            answer += frame["data"]
+    assert answer == "Hello from fake Ollama"
+
+
+# ============== Conversation history ==============
+
+
+def turns(n: int, content: str = "x") -> list[dict]:
+    history = []
+    for i in range(n):
+        history.append({"role": "user", "content": f"{content} question {i}"})
+        history.append({"role": "assistant", "content": f"{content} answer {i}"})
+    return history
+
+
+def test_trim_history_evicts_whole_turns_over_the_turn_limit():
+    history = turns(8)
+    evicted = app.trim_history(history, max_turns=6)
+    assert evicted == turns(2)
+    assert history == turns(8)[4:]
+
+
+def test_trim_history_evicts_over_the_token_budget():
+    history = turns(3, content="y" * 400)  # ~100 tokens per message
+    evicted = app.trim_history(history, max_turns=6, max_tokens=250)
+    assert len(evicted) == 4
+    assert len(history) == 2
+
+
+def chat_over_websocket(client, n_turns: int):
+    with client.websocket_connect("/ws/chat") as websocket:
+        for i in range(n_turns):
+            websocket.send_json({"message": f"question {i}", "mode": "direct"})
+            while websocket.receive_json()["type"] != "done":
+                pass
+
+
+def streamed_chat_messages(fake_ollama) -> list[dict]:
+    return [body["messages"] for body in fake_ollama.chat_requests() if body["stream"]]
+
+
+def test_websocket_summarizes_evicted_turns(client, fake_ollama):
+    chat_over_websocket(client, app.MAX_HISTORY_TURNS + 2)
+    last = streamed_chat_messages(fake_ollama)[-1]
+    assert last[1]["content"].startswith("Earlier conversation summary:")
+    assert all("question 0" not in m["content"] for m in last)
+
+
+def test_websocket_survives_a_failed_summary(client, fake_ollama):
+    fake_ollama.fail_non_streaming_chat = True
+    chat_over_websocket(client, app.MAX_HISTORY_TURNS + 3)
+    requests = streamed_chat_messages(fake_ollama)
+    assert len(requests) == app.MAX_HISTORY_TURNS + 3
+    # The evicted turns were put back instead of being lost
+    last = requests[-1]
+    assert not any(m["content"].startswith("Earlier conversation") for m in last)
+    assert any(m["content"] == "question 0" for m in last)
+
+
+# ============== Semantic cache ==============
+
+
+def unit_vector(seed: int) -> np.ndarray:
+    vector = np.random.default_rng(seed).standard_normal(64)
+    return vector / np.linalg.norm(vector)
+
+
+def test_semantic_cache_hits_near_duplicate_queries():
+    vector = unit_vector(1)
+    documents = [{"id": "a"}]
+    app.semantic_cache_put(b"key", 3, vector, documents)
+
+    nearby = vector + 0.01 * unit_vector(2)
+    assert app.semantic_cache_get(nearby, 3) is documents
+    assert app.semantic_cache_get(unit_vector(3), 3) is None
+    assert app.semantic_cache_get(vector, 5) is None
+
+
+def test_semantic_cache_evicts_the_oldest_entry(monkeypatch):
+    monkeypatch.setattr(app, "SEMANTIC_CACHE_SIZE", 2)
+    for seed in range(3):
+        app.semantic_cache_put(bytes([seed]), 3, unit_vector(seed), [seed])
+    assert app.semantic_cache_get(unit_vector(0), 3) is None
+    assert app.semantic_cache_get(unit_vector(2), 3) == [2]
+
+
+def test_adding_documents_invalidates_the_semantic_cache(client):
+    app.semantic_cache_put(b"key", 3, unit_vector(1), [])
+    client.post("/documents", json={"content": "New fact", "source": "new.md"})
+    assert app.semantic_cache_get(unit_vector(1), 3) is None
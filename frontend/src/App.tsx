@@ -174,7 +174,7 @@ function App() {
 
   // SSE Streaming Chat
   const sendSSE = useCallback(async (message: string) => {
-    const endpoint = mode === 'rag' ? '/chat/rag/stream' : '/chat'
+    const endpoint = mode === 'rag' ? '/chat/rag/stream' : '/chat/stream'
 
     try {
       const res = await fetch(`${API_BASE}${endpoint}`, {
@@ -206,8 +206,22 @@ function App() {
 
               if (data.type === 'sources') {
                 currentMessage.sources = data.content
-              } else if (data.type === 'token') {
-                currentMessage.content += data.content
+              } else if (data.message) {
+                // Ollama chat chunk forwarded as-is by the backend
+                currentMessage.content += data.message.content
+
+                setMessages(prev => {
+                  const newMessages = [...prev]
+                  if (newMessages[messageIndex]) {
+                    newMessages[messageIndex] = { ...currentMessage }
+                  } else {
+                    newMessages.push({ ...currentMessage })
+                  }
+                  return newMessages
+                })
+              } else if (data.error) {
+                // Ollama failed mid-stream
+                currentMessage.content += `Error: ${data.error}`
 
                 setMessages(prev => {
                   const newMessages = [...prev]